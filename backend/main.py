@@ -1,20 +1,28 @@
+import asyncio
+import atexit
 import logging
-import math
 import uuid
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
 from fastapi import FastAPI, Form, Request, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup
 
 from backend.utils import (
     apply_filters,
     apply_sort,
+    build_filter_params,
+    build_row_index,
     get_active_columns,
     load_json,
     save_json,
+    save_json_async,
     format_date_string,
 )
 
@@ -22,7 +30,20 @@ from backend.utils import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("htmx-table")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _sessions_write_lock
+    # Persist session changes in the background, flush what is left on shutdown.
+    # The lock is created here so it belongs to the loop running this lifespan.
+    _sessions_write_lock = asyncio.Lock()
+    flusher = asyncio.create_task(flush_sessions_periodically())
+    yield
+    flusher.cancel()
+    await flush_sessions()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # --- Config & Data ---
 BASE_DIR = Path(__file__).resolve().parent
@@ -32,11 +53,25 @@ DATA_PATH = DATA_DIR / "users_1000.json"
 SESSION_FILE = DATA_DIR / "sessions.json"
 SETTINGS_FILE = DATA_DIR / "app_settings.json"
 
-templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+# Templates only change on deploy, so never re-check them and cache all of them
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader(BASE_DIR / "templates"),
+        autoescape=True,
+        auto_reload=False,
+        cache_size=-1,
+    )
+)
 templates.env.filters["date_format"] = format_date_string
+# /table-data is the hot path, render it directly instead of via TemplateResponse
+TABLE_TEMPLATE = templates.get_template("table.html")
+ROW_TEMPLATE = templates.get_template("row.html")
+# Returned by endpoints of disabled features, htmx leaves the target untouched on 204
+_EMPTY_HTML = HTMLResponse(b"", status_code=204)
 
 # Global State
 DATASET: List[Dict[str, Any]] = []
+ROW_INDEX: Dict[str, Any] = {}
 SESSIONS: Dict[str, Dict[str, Any]] = {}
 APP_SETTINGS: Dict[str, Any] = {
     "features": {"search": True, "column_settings": True, "pagination": True},
@@ -52,6 +87,11 @@ COLUMNS = [
     {"key": "balance_eur", "label": "Balance"},
     {"key": "created_date", "label": "Created"},
 ]
+COLUMN_KEYS = tuple(c["key"] for c in COLUMNS)
+# Column definitions by key, shares the dicts with COLUMNS so in-place updates show in both
+COL_MAP = {c["key"]: c for c in COLUMNS}
+# Bumped whenever the column definitions change, invalidates cached column lists
+COLUMNS_VERSION = 0
 
 # Initialize
 DATASET = load_json(DATA_PATH, [])
@@ -60,22 +100,64 @@ APP_SETTINGS = load_json(SETTINGS_FILE, APP_SETTINGS)
 
 # Merge column settings
 for key, conf in APP_SETTINGS.get("columns", {}).items():
-    for col in COLUMNS:
-        if col["key"] == key:
-            col.update(conf)
+    if key in COL_MAP:
+        COL_MAP[key].update(conf)
+
+# Precompute search values and sort orders once, the dataset is read-only from here on
+ROW_INDEX = build_row_index(DATASET, COLUMNS)
 
 
 # --- Session Management ---
-def get_session(request: Request, response: Response = None) -> Dict[str, Any]:
+# Session changes only mark the sessions as dirty, a background task writes
+# them at most once per SESSION_FLUSH_DELAY instead of on every request.
+# Writes run in a worker thread, the lock keeps them from overlapping.
+# A plain flag and a per-lifespan lock, asyncio primitives created at import
+# would bind to the first event loop and break later lifespans in the process.
+SESSION_FLUSH_DELAY = 1.0
+_sessions_dirty = False
+_sessions_write_lock: Optional[asyncio.Lock] = None
+
+
+def mark_sessions_dirty():
+    global _sessions_dirty
+    _sessions_dirty = True
+
+
+async def flush_sessions():
+    global _sessions_dirty
+    async with _sessions_write_lock:
+        if _sessions_dirty:
+            # Cleared before writing so changes made during the write are kept
+            _sessions_dirty = False
+            if not await save_json_async(SESSION_FILE, SESSIONS, indent=False):
+                # Retry with the next flush
+                _sessions_dirty = True
+
+
+async def flush_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_DELAY)
+        # Shielded so cancelling the task on shutdown never cuts a write short
+        await asyncio.shield(flush_sessions())
+
+
+@atexit.register
+def flush_sessions_at_exit():
+    if _sessions_dirty:
+        save_json(SESSION_FILE, SESSIONS, indent=False)
+
+
+def get_session(request: Request, response: Response = None) -> Tuple[Dict[str, Any], bool]:
+    """Returns the session and whether it was created or changed by this call."""
     sid = request.cookies.get("session_id")
-    save_needed = False
+    dirty = False
 
     if not sid or sid not in SESSIONS:
         sid = str(uuid.uuid4())
         SESSIONS[sid] = {}
         if response:
             response.set_cookie(key="session_id", value=sid)
-        save_needed = True
+        dirty = True
 
     session = SESSIONS[sid]
     default_per_page = APP_SETTINGS["defaults"]["per_page"]
@@ -83,27 +165,54 @@ def get_session(request: Request, response: Response = None) -> Dict[str, Any]:
     # Ensure defaults
     if "per_page" not in session:
         session["per_page"] = default_per_page
-        save_needed = True
+        dirty = True
 
     if "columns" not in session:
         session["columns"] = {
-            "order": [c["key"] for c in COLUMNS],
-            "visible": [c["key"] for c in COLUMNS],
+            "order": list(COLUMN_KEYS),
+            "visible": list(COLUMN_KEYS),
         }
-        save_needed = True
+        dirty = True
 
     if "sort" not in session:
         session["sort"] = {"key": "created_date", "dir": "desc"}
-        save_needed = True
+        dirty = True
 
     if "selection" not in session:
         session["selection"] = {"mode": "include", "ids": []}
-        save_needed = True
+        dirty = True
+
+    return session, dirty
+
 
-    if save_needed:
-        save_json(SESSION_FILE, SESSIONS)
+# Column order, visible columns and COLUMNS_VERSION, the cache key for everything
+# that depends on which columns a session shows
+ColumnLayout = Tuple[Tuple[str, ...], FrozenSet[str], int]
 
-    return session
+
+def get_column_layout(session: Dict[str, Any]) -> ColumnLayout:
+    columns = session["columns"]
+    return tuple(columns["order"]), frozenset(columns["visible"]), COLUMNS_VERSION
+
+
+@lru_cache(maxsize=1024)
+def get_layout_columns(layout: ColumnLayout) -> List[Dict[str, Any]]:
+    """Visible columns in display order, the list must not be modified."""
+    order, visible, _ = layout
+    return get_active_columns(order, visible, COL_MAP)
+
+
+@lru_cache(maxsize=16384)
+def render_row(row_idx: int, layout: ColumnLayout, show_row_selection: bool, selected: bool) -> Markup:
+    """Renders one table row, cached as the dataset is read-only after startup."""
+    return Markup(
+        ROW_TEMPLATE.render(
+            row=DATASET[row_idx],
+            columns=get_layout_columns(layout),
+            show_row_selection=show_row_selection,
+            selected=selected,
+        )
+    )
 
 
 # --- Routes ---
@@ -136,14 +245,11 @@ async def get_table_data(
     dir: Optional[str] = None,
     page: int = 1,
 ):
-    session = get_session(request, response)
+    session, dirty = get_session(request, response)
 
     # Extract column filters
-    column_filters = {}
-    known_keys = [c["key"] for c in COLUMNS]
-    for key, value in request.query_params.items():
-        if key in known_keys and value:
-            column_filters[key] = value
+    query_params = request.query_params
+    column_filters = {key: value for key in COLUMN_KEYS if (value := query_params.get(key))}
 
     # Update session if sort params provided
     if sort:
@@ -151,21 +257,21 @@ async def get_table_data(
         if session["sort"]["key"] != sort or session["sort"]["dir"] != new_dir:
             session["sort"]["key"] = sort
             session["sort"]["dir"] = new_dir
-            save_json(SESSION_FILE, SESSIONS)
+            dirty = True
+
+    if dirty:
+        mark_sessions_dirty()
 
     current_sort = session["sort"]
 
-    filtered_data = apply_filters(
-        DATASET, COLUMNS, q=q, column_filters=column_filters, settings=APP_SETTINGS
+    matches = apply_filters(
+        ROW_INDEX, q=q, column_filters=column_filters, settings=APP_SETTINGS
     )
-    sorted_data = apply_sort(filtered_data, current_sort["key"], current_sort["dir"])
-
-    # Mark selected rows
     sel_mode = session["selection"]["mode"]
     sel_ids = set(session["selection"]["ids"])
     
     # Calculate selection stats
-    total_matching = len(sorted_data)
+    total_matching = len(matches)
     if sel_mode == "include":
         selection_count = len(sel_ids)
         is_global_selected = False
@@ -173,56 +279,62 @@ async def get_table_data(
         selection_count = total_matching - len(sel_ids)
         is_global_selected = (len(sel_ids) == 0)
 
-    for row in sorted_data:
-        rid = str(row.get("id", "")) # Ensure we have ID
-        if sel_mode == "include":
-            row["_selected"] = rid in sel_ids
-        else:
-            row["_selected"] = rid not in sel_ids
-
     page_info = None
     if APP_SETTINGS["features"]["pagination"]:
         per_page = session.get("per_page", 10)
-        total_items = len(sorted_data)
-        total_pages = math.ceil(total_items / per_page)
+        total_items = total_matching
+        total_pages = (total_items + per_page - 1) // per_page
         page = max(1, min(page, total_pages)) if total_pages > 0 else 1
 
         start = (page - 1) * per_page
         end = start + per_page
-        paged_data = sorted_data[start:end]
         page_info = {"current": page, "total": total_pages, "total_items": total_items}
     else:
-        paged_data = sorted_data[:100]
+        start, end = 0, 100
 
-    active_cols = get_active_columns(session, COLUMNS)
+    # Only sort up to the end of the page and materialize just its rows
+    sorted_idx = apply_sort(ROW_INDEX, matches, current_sort["key"], current_sort["dir"], limit=end)
+    paged_idx = sorted_idx[start:end]
+    paged_data = [DATASET[i] for i in paged_idx]
 
-    # Filter string for pagination links
-    filter_params = ""
-    if column_filters:
-        for k, v in column_filters.items():
-            if v:
-                filter_params += f"&{k}={v}"
+    # Resolve the selection for the shown rows only, the shared rows stay untouched
+    page_ids = [str(row.get("id", "")) for row in paged_data]
+    include = sel_mode == "include"
+    selected_ids = frozenset(rid for rid in page_ids if (rid in sel_ids) == include)
 
-    resp = templates.TemplateResponse(
-        request=request,
-        name="table.html",
-        context={
-            "rows": paged_data,
-            "columns": active_cols,
-            "current_sort": current_sort,
-            "page_info": page_info,
-            "filters": column_filters,
-            "filter_params": filter_params,
-            "show_filters": APP_SETTINGS["features"].get("column_filters", False),
-            "show_row_selection": APP_SETTINGS["features"].get("row_selection", False),
-            "selection_info": {
-                "count": selection_count,
-                "total": total_matching,
-                "is_global": is_global_selected,
-                "mode": sel_mode
-            }
-        },
-    )
+    layout = get_column_layout(session)
+    active_cols = get_layout_columns(layout)
+
+    # Rows are rendered once per layout and selection state, then reused
+    show_row_selection = APP_SETTINGS["features"].get("row_selection", False)
+    row_htmls = [
+        render_row(i, layout, show_row_selection, rid in selected_ids)
+        for i, rid in zip(paged_idx, page_ids)
+    ]
+
+    # Filter string for pagination links
+    filter_params = build_filter_params(tuple(column_filters.items()))
+
+    context = {
+        "rows": paged_data,
+        "row_htmls": row_htmls,
+        "columns": active_cols,
+        "current_sort": current_sort,
+        "page_info": page_info,
+        "filters": column_filters,
+        "filter_params": filter_params,
+        "page_ids": ",".join(page_ids),
+        "selected_ids": selected_ids,
+        "show_filters": APP_SETTINGS["features"].get("column_filters", False),
+        "show_row_selection": show_row_selection,
+        "selection_info": {
+            "count": selection_count,
+            "total": total_matching,
+            "is_global": is_global_selected,
+            "mode": sel_mode
+        }
+    }
+    resp = HTMLResponse(TABLE_TEMPLATE.render(context))
     # Ensure session cookie is preserved
     if response.headers.get("set-cookie"):
         resp.headers["set-cookie"] = response.headers["set-cookie"]
@@ -232,9 +344,11 @@ async def get_table_data(
 @app.get("/table-settings", response_class=HTMLResponse)
 async def get_settings_control(request: Request, response: Response):
     if not APP_SETTINGS["features"]["pagination"]:
-        return ""
+        return _EMPTY_HTML
 
-    session = get_session(request, response)
+    session, dirty = get_session(request, response)
+    if dirty:
+        mark_sessions_dirty()
     current = session.get("per_page", 10)
     options = APP_SETTINGS["defaults"]["per_page_options"]
 
@@ -251,18 +365,20 @@ async def get_settings_control(request: Request, response: Response):
 @app.get("/table-settings-modal", response_class=HTMLResponse)
 async def get_settings_modal(request: Request, response: Response, q: Optional[str] = None):
     if not APP_SETTINGS["features"]["column_settings"]:
-        return ""
+        return _EMPTY_HTML
 
-    session = get_session(request, response)
+    session, dirty = get_session(request, response)
+    if dirty:
+        mark_sessions_dirty()
     order = session["columns"]["order"]
     visible = set(session["columns"]["visible"])
-    col_map = {c["key"]: c for c in COLUMNS}
+    ordered = set(order)
 
-    all_keys = list(order) + [c["key"] for c in COLUMNS if c["key"] not in order]
+    all_keys = list(order) + [key for key in COLUMN_KEYS if key not in ordered]
 
     items = []
     for key in all_keys:
-        col = col_map.get(key)
+        col = COL_MAP.get(key)
         if not col:
             continue
         items.append({
@@ -291,19 +407,23 @@ async def update_settings(
     order: List[str] = Form(default=None),
     pattern_created_date: Optional[str] = Form(None)
 ):
-    session = get_session(request, response)
+    global COLUMNS_VERSION
+    session, dirty = get_session(request, response)
 
     logger.info(f"Update settings: visible={visible}, order={order}, pattern={pattern_created_date}")
 
     if per_page is not None and APP_SETTINGS["features"]["pagination"]:
+        dirty = dirty or session["per_page"] != per_page
         session["per_page"] = per_page
 
     if APP_SETTINGS["features"]["column_settings"]:
         # If 'order' is present, it means the column settings form was submitted.
         # In this case, if 'visible' is missing (None), it implies all columns were unchecked.
         if order is not None:
+            visible = visible if visible is not None else []
+            dirty = dirty or session["columns"]["order"] != order or session["columns"]["visible"] != visible
             session["columns"]["order"] = order
-            session["columns"]["visible"] = visible if visible is not None else []
+            session["columns"]["visible"] = visible
             
             # Handle date pattern update
             if pattern_created_date is not None:
@@ -314,15 +434,14 @@ async def update_settings(
                     APP_SETTINGS["columns"]["created_date"] = {}
                 
                 APP_SETTINGS["columns"]["created_date"]["custom_pattern"] = pattern_created_date
-                save_json(SETTINGS_FILE, APP_SETTINGS)
+                await save_json_async(SETTINGS_FILE, APP_SETTINGS)
                 
                 # Update in-memory columns
-                for col in COLUMNS:
-                    if col["key"] == "created_date":
-                        col["custom_pattern"] = pattern_created_date
-                        break
+                COL_MAP["created_date"]["custom_pattern"] = pattern_created_date
+                COLUMNS_VERSION += 1
 
-    save_json(SESSION_FILE, SESSIONS)
+    if dirty:
+        mark_sessions_dirty()
 
     # Delegate to get_table_data to render the updated table
     return await get_table_data(request, response, q=q)
@@ -338,9 +457,10 @@ async def update_selection(
     q: Optional[str] = Form(None),
     page: int = Form(1)
 ):
-    session = get_session(request, response)
+    session, dirty = get_session(request, response)
     mode = session["selection"]["mode"]
-    current_ids = set(session["selection"]["ids"])
+    previous_ids = set(session["selection"]["ids"])
+    current_ids = set(previous_ids)
 
     if action == "toggle":
         if not id:
@@ -381,8 +501,12 @@ async def update_selection(
         session["selection"]["mode"] = "include"
         current_ids = set()
 
-    session["selection"]["ids"] = list(current_ids)
-    save_json(SESSION_FILE, SESSIONS)
+    if session["selection"]["mode"] != mode or current_ids != previous_ids:
+        session["selection"]["ids"] = list(current_ids)
+        dirty = True
+
+    if dirty:
+        mark_sessions_dirty()
     
     # Delegate to get_table_data to render the updated table
     # The frontend should include current params.
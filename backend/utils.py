@@ -1,11 +1,64 @@
+import asyncio
 import logging
+import os
+import tempfile
 import orjson
+from bisect import bisect_right
+from functools import lru_cache
+from heapq import nlargest, nsmallest
+from itertools import islice
 from pathlib import Path
-from typing import List, Optional, Any, Dict
-from datetime import datetime
+from urllib.parse import urlencode
+from typing import Callable, Collection, List, Optional, Any, Dict, Sequence, Tuple
+from datetime import date, datetime
 
 logger = logging.getLogger("htmx-table")
 
+# Placeholders and where their digits sit in a YYYY-MM-DD string
+_DATE_PARTS = (("YYYY", slice(0, 4)), ("MM", slice(5, 7)), ("DD", slice(8, 10)))
+
+@lru_cache(maxsize=32)
+def _compile_date_pattern(pattern: str) -> Optional[Callable[[Any], Optional[str]]]:
+    """
+    Builds a formatter for the pattern that slices the digits straight out of a
+    YYYY-MM-DD string, skipping strptime/strftime. The formatter returns None
+    for anything else, including impossible dates and years before 1000
+    (strftime does not zero-pad those), so the caller falls back to the strptime
+    path. Patterns containing % are left to strftime (None).
+    """
+    if "%" in pattern:
+        return None
+
+    # Split into slices and literal text, same precedence as the replace() chain
+    parts = []
+    pos = 0
+    while pos < len(pattern):
+        for token, part in _DATE_PARTS:
+            if pattern.startswith(token, pos):
+                parts.append(part)
+                pos += len(token)
+                break
+        else:
+            if parts and isinstance(parts[-1], str):
+                parts[-1] += pattern[pos]
+            else:
+                parts.append(pattern[pos])
+            pos += 1
+
+    def format_date(date_str: Any) -> Optional[str]:
+        if not (isinstance(date_str, str) and len(date_str) == 10 and date_str[4] == date_str[7] == "-"
+                and date_str[:4].isdigit() and date_str[5:7].isdigit() and date_str[8:].isdigit()
+                and date_str[:4] >= "1000"):
+            return None
+        try:
+            # Rejects month/day combinations that do not exist, like 2024-02-30
+            date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:]))
+        except ValueError:
+            return None
+        return "".join([date_str[part] if isinstance(part, slice) else part for part in parts])
+
+    return format_date
+
 def format_date_string(date_str: str, pattern: str) -> str:
     """
     Formats a date string (expected in YYYY-MM-DD) according to the given pattern.
@@ -13,6 +66,12 @@ def format_date_string(date_str: str, pattern: str) -> str:
     """
     if not date_str or not pattern:
         return date_str
+
+    format_date = _compile_date_pattern(pattern)
+    if format_date is not None:
+        formatted = format_date(date_str)
+        if formatted is not None:
+            return formatted
         
     try:
         # Parse the input date (assuming YYYY-MM-DD from the JSON)
@@ -39,54 +98,196 @@ def load_json(path: Path, default: Any) -> Any:
         logger.error(f"Error loading {path}: {e}")
         return default
 
-def save_json(path: Path, data: Any):
+def save_json(path: Path, data: Any, indent: bool = True) -> bool:
+    """
+    Writes data as JSON, indent only files meant to be edited by hand. Returns
+    whether it worked. The data goes to a temp file that then replaces path, so
+    readers and concurrent writers (worker threads) never see a partial file.
+    """
+    tmp_path = None
     try:
-        with open(path, 'wb') as f:
-            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        content = orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+        fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix=f".{Path(path).name}.", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        # mkstemp creates the file owner-only, keep the mode of the file being replaced
+        os.chmod(tmp_path, os.stat(path).st_mode if os.path.exists(path) else 0o644)
+        os.replace(tmp_path, path)
+        return True
     except Exception as e:
         logger.error(f"Error saving {path}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
 
-def apply_filters(rows: List[Dict[str, Any]], columns: List[Dict[str, Any]], q: Optional[str] = None, column_filters: Dict[str, str] = None, settings: Dict[str, Any] = None):
-    result = rows
-    
-    # Global search
-    if q and settings and settings.get("features", {}).get("search"):
-        search = q.lower()
-        searchable_keys = [col["key"] for col in columns]
-        
-        filtered_result = []
-        for u in result:
-            # Check if search term exists in any of the columns
-            if any(search in str(u.get(key, '')).lower() for key in searchable_keys):
-                filtered_result.append(u)
-        result = filtered_result
-        
-    # Column filters
+async def save_json_async(path: Path, data: Any, indent: bool = True) -> bool:
+    """Runs save_json in a worker thread so the event loop is not blocked by disk I/O."""
+    return await asyncio.to_thread(save_json, path, data, indent)
+
+# Separates the rows inside a joined search blob, must not occur in the data
+_ROW_SEP = b"\x1e"
+
+def _search_bytes(value: Any) -> bytes:
+    """
+    Lowercased UTF-8 form used for searching. Lowercasing happens on the str so
+    non-ASCII letters fold correctly, bytes.find then skips the unicode
+    handling str.find needs. UTF-8 only matches on character boundaries, so
+    results are the same as searching the str.
+    """
+    return str(value).lower().encode()
+
+def _join_rows(values: List[bytes]) -> Tuple[bytes, List[int]]:
+    """
+    Joins the per-row values into one buffer and returns it together with the
+    offset at which each row starts, so a single bytes.find can scan all rows.
+    """
+    starts = []
+    pos = 0
+    for value in values:
+        starts.append(pos)
+        pos += len(value) + len(_ROW_SEP)
+    return _ROW_SEP.join(values), starts
+
+def _find_rows(blob: Tuple[bytes, List[int]], needle: bytes) -> List[int]:
+    """Returns the indices of all rows in the joined blob that contain needle."""
+    text, starts = blob
+    if _ROW_SEP in needle:
+        return []
+
+    hits = []
+    last = len(starts) - 1
+    pos = text.find(needle)
+    while pos != -1:
+        i = bisect_right(starts, pos) - 1
+        hits.append(i)
+        if i == last:
+            break
+        # Continue with the next row, one hit per row is enough
+        pos = text.find(needle, starts[i + 1])
+    return hits
+
+def _sort_val(val: Any) -> Any:
+    if val is None: return ""
+    if isinstance(val, (int, float)): return val
+    return str(val).lower()
+
+def _date_ordinal(val: Any) -> int:
+    """Day number of a YYYY-MM-DD string, 0 for missing or invalid dates."""
+    try:
+        return date.fromisoformat(val).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+def _sort_order(rows: List[Dict[str, Any]], sort_key: str, reverse: bool, is_date: bool = False) -> List[int]:
+    """Returns the row indices ordered by the given key (stable, like sorted())."""
+    to_val = _date_ordinal if is_date else _sort_val
+    values = [to_val(u.get(sort_key)) for u in rows]
+    return sorted(range(len(rows)), key=values.__getitem__, reverse=reverse)
+
+def build_row_index(rows: List[Dict[str, Any]], columns: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Precomputes everything filtering and sorting need, rows must not change
+    after the index is built.
+
+    Searchable values are lowercased and encoded once and stored per column
+    (one list per key) plus a joined per-row haystack for the global search.
+    Each of them is also joined into a single blob, which lets an unfiltered
+    scan run inside bytes.find. Scan results are memoized per (column, needle), the key None
+    being the global haystack. For every column the row order is sorted once
+    in both directions, so a request only has to pick a permutation. Columns
+    with a date pattern are sorted by their day number. The number of distinct
+    values per column serves as a selectivity estimate for ordering filters.
+    """
+    keys = [col["key"] for col in columns]
+    date_keys = {col["key"] for col in columns if col.get("default_pattern") or col.get("custom_pattern")}
+    lower_cols = {key: [_search_bytes(u.get(key, '')) for u in rows] for key in keys}
+    haystack = [b"\x1f".join(values) for values in zip(*lower_cols.values())] if keys else [b""] * len(rows)
+
+    blobs = {key: _join_rows(values) for key, values in lower_cols.items()}
+    blobs[None] = _join_rows(haystack)
+
+    @lru_cache(maxsize=512)
+    def find_rows(key: Optional[str], needle: bytes) -> Tuple[int, ...]:
+        return tuple(_find_rows(blobs[key], needle))
+
+    return {
+        "rows": rows,
+        "columns": lower_cols,
+        "haystack": haystack,
+        "distinct": {key: len(set(values)) for key, values in lower_cols.items()},
+        "find_rows": find_rows,
+        "sort_asc": {key: _sort_order(rows, key, False, key in date_keys) for key in keys},
+        "sort_desc": {key: _sort_order(rows, key, True, key in date_keys) for key in keys},
+    }
+
+def apply_filters(index: Dict[str, Any], q: Optional[str] = None, column_filters: Dict[str, str] = None, settings: Dict[str, Any] = None):
+    """Returns the indices of all matching rows in ascending order."""
+    # Collect (column, needle) predicates, None being the global search
+    predicates = []
     if column_filters:
         for key, value in column_filters.items():
             if not value: continue
-            needle = value.lower()
-            result = [u for u in result if needle in str(u.get(key, '')).lower()]
+            if key not in index["columns"]:
+                # Not an indexed column, so no row can match
+                return []
+            predicates.append((key, _search_bytes(value)))
+
+    # Run the most selective filter first, so the others only check its matches.
+    # Columns with more distinct values (and longer needles) match fewer rows,
+    # the global search runs last as it matches in any column.
+    distinct = index["distinct"]
+    predicates.sort(key=lambda p: (distinct[p[0]], len(p[1])), reverse=True)
+    if q and settings and settings.get("features", {}).get("search"):
+        predicates.append((None, _search_bytes(q)))
+
+    result_idx = None  # None means no filter applied yet, i.e. all rows
+    for key, needle in predicates:
+        if result_idx is None:
+            result_idx = index["find_rows"](key, needle)
+        else:
+            values = index["haystack"] if key is None else index["columns"][key]
+            result_idx = [i for i in result_idx if needle in values[i]]
+        if not result_idx:
+            break
             
-    return result
+    if result_idx is None:
+        return range(len(index["rows"]))
+    return result_idx
 
-def apply_sort(rows: List[Dict[str, Any]], sort_key: str, sort_dir: str):
+def apply_sort(index: Dict[str, Any], result_idx: Sequence[int], sort_key: str, sort_dir: str, limit: Optional[int] = None) -> Sequence[int]:
+    """
+    Returns the matching row indices in sort order, only the first `limit` of
+    them if given (e.g. up to the end of the current page). Only indices are
+    moved around, callers pick the rows they actually show.
+    """
+    rows = index["rows"]
     if not sort_key:
-        return rows
+        return result_idx[:limit]
         
     reverse = (sort_dir == 'desc')
-    
-    def sort_val(row):
-        val = row.get(sort_key)
-        if val is None: return ""
-        if isinstance(val, (int, float)): return val
-        return str(val).lower()
-        
-    return sorted(rows, key=sort_val, reverse=reverse)
+    order = index["sort_desc" if reverse else "sort_asc"].get(sort_key)
+    if order is None:
+        # Not an indexed column, sort the matches on the fly. For a small limit
+        # a heap selection gives the same result as sorted()[:limit].
+        def sort_val(i):
+            return _sort_val(rows[i].get(sort_key))
+        if limit is not None and limit < len(result_idx) // 2:
+            return (nlargest if reverse else nsmallest)(limit, result_idx, key=sort_val)
+        return sorted(result_idx, key=sort_val, reverse=reverse)[:limit]
+
+    if len(result_idx) < len(rows):
+        # Walk the permutation, keep matching rows and stop once enough are found
+        keep = bytearray(len(rows))
+        for i in result_idx:
+            keep[i] = 1
+        return list(islice((i for i in order if keep[i]), limit))
+
+    return order[:limit]
+
+@lru_cache(maxsize=512)
+def build_filter_params(items: Tuple[Tuple[str, str], ...]) -> str:
+    """Query string suffix ("&key=value...") carrying the column filters in links."""
+    return "&" + urlencode(items) if items else ""
 
-def get_active_columns(session: Dict[str, Any], all_columns: List[Dict[str, Any]]):
-    order = session["columns"]["order"]
-    visible = set(session["columns"]["visible"])
-    col_map = {c['key']: c for c in all_columns}
-    
+def get_active_columns(order: Sequence[str], visible: Collection[str], col_map: Dict[str, Dict[str, Any]]):
     return [col_map[key] for key in order if key in visible and key in col_map]